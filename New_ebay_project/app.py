@@ -8,11 +8,28 @@ from dotenv import load_dotenv
 import os
 import base64
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
-from datetime import datetime, timezone
+import random
+import threading
+from datetime import datetime, timedelta, timezone
 import math
+import re
+from functools import lru_cache
+from collections import deque
+from urllib.parse import urlencode
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from scipy import stats
 import numpy as np
+try:
+    import orjson as json_parser  # C extension, parses eBay's large search pages much faster
+except ImportError:
+    import json as json_parser
+try:
+    import requests_cache  # Optional on-disk cache for search pages that survives app restarts
+except ImportError:
+    requests_cache = None
 
 # Load environment variables from .env file
 load_dotenv()
@@ -25,139 +42,556 @@ EBAY_API_REFRESH_TOKEN = os.getenv("EBAY_API_REFRESH_TOKEN")
 if not EBAY_API_CLIENT_ID or not EBAY_API_CLIENT_SECRET or not EBAY_API_REFRESH_TOKEN:
     st.error("eBay API credentials or refresh token are missing. Please set them in a .env file or as environment variables.")
 
+# Base64-encoded client credentials for the OAuth token request, these never change so encode them once
+BASIC_AUTH_HEADER = "Basic " + base64.b64encode(f"{EBAY_API_CLIENT_ID}:{EBAY_API_CLIENT_SECRET}".encode()).decode()
+
+# OAuth token request, identical for every refresh
+TOKEN_URL = "https://api.ebay.com/identity/v1/oauth2/token"
+TOKEN_HEADERS = {
+    "Content-Type": "application/x-www-form-urlencoded",
+    "Authorization": BASIC_AUTH_HEADER
+}
+TOKEN_REQUEST_DATA = {
+    "grant_type": "refresh_token",
+    "refresh_token": EBAY_API_REFRESH_TOKEN,
+    "scope": "https://api.ebay.com/oauth/api_scope"
+}
+
+# Maximum number of items searched on eBay at the same time
+MAX_WORKERS = 8
+# Maximum number of result pages fetched at the same time for a single item
+MAX_PAGE_WORKERS = 4
+# The Browse API won't page past this many results
+MAX_RESULTS = 10000
+# Maximum number of search requests in flight at once across all items and pages
+MAX_CONCURRENT_REQUESTS = 16
+# Steady-state rate of search requests sent to eBay
+REQUESTS_PER_SECOND = 5
+# Retry settings for throttled (429) or unavailable (503) responses
+RETRY_STATUS_CODES = (429, 503)
+MAX_ATTEMPTS = 4
+BACKOFF_BASE = 0.1  # Seconds
+BACKOFF_CAP = 0.8  # Seconds
+MAX_RETRY_AFTER = 30  # Seconds, longer Retry-After waits fail the item instead of stalling the app
+# Browse API item search endpoint and the headers sent with every search, apart from the token
+SEARCH_URL = "https://api.ebay.com/buy/browse/v1/item_summary/search"
+SEARCH_HEADERS = {
+    "Content-Type": "application/json",
+    "X-EBAY-C-MARKETPLACE-ID": "EBAY_GB"  # Specify the UK marketplace
+}
+# Minimum seconds between redraws of the progress text, bar and results preview
+PROGRESS_REDRAW_INTERVAL = 0.1
+# Most redraws of the progress display in one batch, however many items it has
+MAX_PROGRESS_REDRAWS = 100
+# Seconds each item's search results stay cached, prices move too quickly to keep them for longer
+SEARCH_CACHE_TTL = 60 * 60
+# Most item searches kept in memory at once, each distinct item and option combination is its own entry
+SEARCH_CACHE_MAX_ENTRIES = 2000
+# Seconds to wait for eBay before giving up on a request
+REQUEST_TIMEOUT = 10
+# How long past expiry a cached page may still be served when eBay can't be reached, older pages are purged
+HTTP_CACHE_STALE_LIMIT = timedelta(hours=2)
+# SQLite file the search pages are cached in when requests-cache is installed
+HTTP_CACHE_NAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ebay_cache")
+
+# Dropped connections and gateway errors are retried by urllib3, throttling (429/503) by request_with_backoff
+TRANSPORT_RETRY = Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 504), raise_on_status=False)
+
+# Streamlit re-runs this script on every interaction, so the shared HTTP objects below are created through
+# st.cache_resource to live for the whole process instead of being rebuilt (and their connections dropped) each rerun
+
+@st.cache_resource
+def get_session():
+    """Shared HTTP session so connections to eBay are kept alive and reused between requests, reruns and sessions."""
+    if requests_cache is not None:
+        # Only GETs (search pages) are cached, never the token POST, and the Authorization header isn't part of the key
+        # Each page's offset is in its URL, so pages are cached independently
+        # Stale pages are only served when eBay can't be reached at all, see request_with_backoff
+        session = requests_cache.CachedSession(
+            HTTP_CACHE_NAME,
+            backend="sqlite",
+            expire_after=SEARCH_CACHE_TTL,
+            allowable_methods=("GET",),
+        )
+        # Pages are never removed on their own, clear out any too old to serve so the file doesn't grow without limit
+        session.cache.delete(older_than=timedelta(seconds=SEARCH_CACHE_TTL) + HTTP_CACHE_STALE_LIMIT)
+    else:
+        session = requests.Session()
+    # Every request goes to api.ebay.com and holds a request slot, so one host pool of that size is enough
+    # to keep a connection alive for every request in flight
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=MAX_CONCURRENT_REQUESTS, max_retries=TRANSPORT_RETRY))
+    session.headers["Accept-Encoding"] = "gzip, deflate"  # Search pages are large JSON, always ask for them compressed
+    return session
+
+@st.cache_resource
+def get_request_slots():
+    """Shared by every worker thread so the item and page pools together stay under MAX_CONCURRENT_REQUESTS."""
+    return threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+
+SESSION = get_session()
+_REQUEST_SLOTS = get_request_slots()
+
+# Refresh the token this many seconds before it actually expires
+TOKEN_EXPIRY_MARGIN = 60
+
+# Complete list of grading companies to filter
+ALL_GRADING_COMPANIES = ("PSA", "BECKETT", "BGS", "CGC", "SGC", "AGS", "TAG", "ACE", "PG", "GET GRADED")
+# Words to exclude from search results
+EXCLUDED_WORDS = ("Magnetic", "Stand", "Proxy", "Custom", "Box", "Playmat")
+# Searches for these are Pokemon Center promos
+POKEMON_CENTER_PROMO_SEARCHES = ("pokemon center promo", "pokemon centre promo")
+# Pokemon Center promo titles must contain one of these
+POKEMON_CENTER_NAMES = ("pokemon center", "pokemon centre")
+# Phrases that mark a listing as a Pokemon Center promo, used to exclude them from regular promo searches
+# Every "e" also matches "é" or "è" (see CENTER_RE), so "pokémon center" is covered by "pokemon center"
+CENTER_PATTERNS = (
+    "pokemon center", "pokemon centre",
+    "center stamped", "centre stamped",
+    "pc stamped", "pc stamp",
+    "center pc", "centre pc"
+)
+
 # Functions
 @st.cache_data
 def parse_input(user_input, quantity_mode):
     """Parses user input from textarea."""
-    lines = user_input.strip().split("\n")
-    data = []
-    for line in lines:
-        try:
-            if quantity_mode == "Quantity":
-                # Expect "item name, quantity" format
-                name, quantity = line.split(",")
-                data.append({"Item": name.strip(), "Quantity": int(quantity.strip())})
-            else:
-                # Expect only "item name" format
-                name = line.strip()
-                data.append({"Item": name})
-        except ValueError:
-            st.warning(f"Invalid line format: {line}")
-    return pd.DataFrame(data)
-
-@st.cache_data(ttl=600)  # Cache for 10 minutes
+    lines = pd.Series(user_input.strip().split("\n"))
+    if quantity_mode == "Quantity":
+        # Expect "item name, quantity" format, split every line at its first comma in one go
+        parts = lines.str.partition(",")
+        names = parts[0].str.strip()
+        quantities = parts[2].str.strip()
+
+        # Lines without a comma or without a whole-number quantity are invalid, report them all at once
+        valid = quantities.str.fullmatch(r"[+-]?\d+")
+        if not valid.all():
+            st.warning("Invalid line format: " + "; ".join(lines[~valid]))
+        return pd.DataFrame({"Item": names[valid], "Quantity": quantities[valid].astype(int)}).reset_index(drop=True)
+
+    # Expect only "item name" format
+    return pd.DataFrame({"Item": lines.str.strip()})
+
+def search_key(item_name):
+    """Canonical form of an item name, so lines differing only in case or spacing share one cached search."""
+    # Matching lowercases everything and eBay search is case-insensitive, so this doesn't change the results
+    return " ".join(item_name.lower().split())
+
+def run_inline(fn, *args, **kwargs):
+    """Runs fn on the calling thread and wraps the outcome in a Future, the same as ThreadPoolExecutor.submit would."""
+    future = Future()
+    try:
+        future.set_result(fn(*args, **kwargs))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
 def fetch_ebay_data(data, include_shipping, sale_type, listing_count, quantity_mode, grading_companies=[], exclude_outliers=False):
-    """Fetches eBay data item by item and includes individual listings in the results."""
-    results = []
-    averages = []  # Store average prices for each item
-    
-    # Define the complete list of grading companies to filter
-    all_grading_companies = ["PSA", "BECKETT", "BGS", "CGC", "SGC", "AGS", "TAG", "ACE", "PG", "GET GRADED"]
+    """Fetches eBay data for all items concurrently and includes individual listings in the results."""
+    # Built column by column and turned into DataFrames once at the end
+    results = {"Item": [], "Title": [], "Price (GBP)": [], "Link": []}
+    averages = {"Item": [], "Unit Average Price (GBP)": [], "Warning": []}  # Store average prices for each item
+
+    # Authenticate once for the whole batch, on this thread, and share the token with every worker
+    # Done before any progress widgets exist, so a failure doesn't leave a spinning status box behind
+    access_token = get_access_token()
     
-    progress_bar = st.progress(0)
     total_items = len(data)
-    
-    for i, (_, row) in enumerate(data.iterrows()):
-        # Update progress
-        progress_text = f"Fetching data for item {i+1} of {total_items}: {row['Item']}"
-        st.write(progress_text)
-        progress_bar.progress((i+1)/total_items)
-        
-        # Fetch data
-        item_name = row["Item"]
-        quantity = row.get("Quantity", 1)  # Default to 1 if no quantity is provided
-
-        # Fetch active listings only
-        avg_price, prices, links, titles, warning = get_active_listings(
-            item_name, 
-            include_shipping=include_shipping, 
-            sale_type=sale_type, 
-            grading_companies=grading_companies,
-            all_grading_companies=all_grading_companies,
-            exclude_outliers=exclude_outliers  # Pass the new parameter
-        )
-        
-        # No need for additional filtering here as we'll handle it all in get_active_listings
-        
-        # Recalculate average price after filtering
-        avg_price = sum(prices) / len(prices) if prices else None
-        averages.append({"Item": item_name, "Unit Average Price (GBP)": avg_price, "Warning": warning})
+    status = st.status(f"Fetching data for {total_items} items...", expanded=True)
+    progress_line = status.empty()  # Overwritten in place rather than adding a line per item
+    progress_bar = st.progress(0)
+    last_redraw = 0.0
+    redraw_every = max(1, -(-total_items // MAX_PROGRESS_REDRAWS))  # Items between redraws, rounded up to stay under the cap
+    results_placeholder = st.empty()  # Shows each item's average as soon as it is ready
+
+    # Build the work list up front so results can be put back in input order
+    # Zip just the two columns needed rather than building a row object (with every CSV column) per row
+    quantities = data["Quantity"] if "Quantity" in data.columns else [1] * total_items  # Default to 1 if no quantity is provided
+    items = list(zip(data["Item"], quantities))
+    item_results = {}
+
+    # The searches are network-bound, so run them on a bounded thread pool
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # A single search gains nothing from a worker thread, so run it here and never start the pool
+        submit = executor.submit if total_items > 1 else run_inline
+        futures = {
+            submit(
+                fetch_item_listings,
+                search_key(item_name),
+                include_shipping=include_shipping,
+                sale_type=sale_type,
+                listing_count=listing_count,
+                grading_companies=tuple(sorted(grading_companies)),  # Hashable and order-independent cache key
+                exclude_outliers=exclude_outliers,
+                _access_token=access_token
+            ): i
+            for i, (item_name, quantity) in enumerate(items)
+        }
 
-        # Add individual listings to the results
-        for price, link, title in zip(prices, links, titles):
-            results.append({
-                "Item": item_name,
-                "Title": title,
-                "Price (GBP)": price,
-                "Link": link
-            })
+        for done, future in enumerate(as_completed(futures), start=1):
+            i = futures[future]
+            try:
+                item_results[i] = future.result()
+            except Exception as e:
+                # Record the failure against this item and let the others finish
+                item_results[i] = (None, [], [], [], str(e))
+
+            # Redraw the progress display at most every PROGRESS_REDRAW_INTERVAL seconds and MAX_PROGRESS_REDRAWS times,
+            # every call sends an update to the browser, but always show the final state
+            now = time.monotonic()
+            if done < total_items and (now - last_redraw < PROGRESS_REDRAW_INTERVAL or done % redraw_every):
+                continue
+            last_redraw = now
+
+            # Update progress
+            progress_text = f"Fetched data for item {done} of {total_items}: {items[i][0]}"
+            progress_line.text(progress_text)
+            status.update(label=f"Fetched {done} of {total_items} items")
+            progress_bar.progress(done / total_items)
+
+            # Show the averages fetched so far, in input order
+            results_placeholder.dataframe(pd.DataFrame([
+                {"Item": items[j][0], "Unit Average Price (GBP)": item_results[j][0], "Warning": item_results[j][4]}
+                for j in sorted(item_results)
+            ]))
+
+    for i, (item_name, quantity) in enumerate(items):
+        # get_active_listings already averaged (and rounded down) the filtered prices, None when there are none
+        avg_price, prices, links, titles, warning = item_results[i]
+        averages["Item"].append(item_name)
+        averages["Unit Average Price (GBP)"].append(avg_price)
+        averages["Warning"].append(warning)
 
+        # Add individual listings to the results
+        if prices:
+            results["Item"].extend([item_name] * len(prices))
+            results["Title"].extend(titles)
+            results["Price (GBP)"].extend(prices)
+            results["Link"].extend(links)
         # Add a warning if no listings are found
-        if not prices:
-            results.append({
-                "Item": item_name,
-                "Title": "No matching listings found.",
-                "Price (GBP)": None,
-                "Link": None
-            })
+        else:
+            results["Item"].append(item_name)
+            results["Title"].append("No matching listings found.")
+            results["Price (GBP)"].append(None)
+            results["Link"].append(None)
     
+    progress_line.empty()
     progress_bar.empty()  # Clear the progress bar when done
-    return averages, results
+    results_placeholder.empty()  # The full results table replaces the preview
+    status.update(label=f"Fetched data for {total_items} items", state="complete", expanded=False)
+    return pd.DataFrame(averages), pd.DataFrame(results)
+
+@st.cache_resource
+def get_token_cache():
+    """Holds the OAuth access token and the time it expires at, shared across reruns and sessions."""
+    return {"value": None, "exp": 0, "lock": threading.Lock()}
 
 def get_access_token():
-    """Generates a new access token using the refresh token."""
+    """Returns a cached access token, generating a new one from the refresh token when it is about to expire."""
+    token = get_token_cache()
+    # Fast path: a valid token is returned without waiting on the lock
+    # exp is read first because a refresh writes it after value, so a fresh exp always comes with its own token
+    exp = token["exp"]
+    value = token["value"]
+    if value and time.time() < exp - TOKEN_EXPIRY_MARGIN:
+        return value
+
+    # Hold the lock while refreshing so parallel workers don't all request a new token at once
+    with token["lock"]:
+        # Another worker may have refreshed it while we waited for the lock
+        if token["value"] and time.time() < token["exp"] - TOKEN_EXPIRY_MARGIN:
+            return token["value"]
+
+        try:
+            response = request_with_backoff(TOKEN_URL, TOKEN_HEADERS, method="POST", data=TOKEN_REQUEST_DATA)
+            if response.status_code == 200:
+                token_data = parse_json(response)
+                token["value"] = token_data["access_token"]
+                token["exp"] = time.time() + token_data.get("expires_in", 0)
+                return token["value"]
+            elif response.status_code == 401:
+                raise Exception("Authentication failed. Please check your eBay API credentials.")
+            else:
+                # The body is only shown to the user, so don't parse it (it may not even be JSON)
+                raise Exception(f"Error refreshing access token: {response.text}")
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            # Raise rather than st.stop(), which does nothing on the worker threads that refresh after a 401
+            raise ConnectionError("Network connection error. Please check your internet connection and try again.") from e
+
+def invalidate_access_token(stale_token):
+    """Forces the next get_access_token call to refresh, unless another worker already replaced the stale token."""
+    token = get_token_cache()
+    with token["lock"]:
+        if token["value"] == stale_token:
+            token["exp"] = 0
+
+class TokenBucket:
+    """Thread-safe token bucket used to pace requests to eBay."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate  # Tokens added per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        """Adds the tokens earned since the last update, must be called with the lock held."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Blocks until a token is available, then takes it."""
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def hold(self, delay):
+        """Stops every caller from getting a token for delay seconds, at most MAX_RETRY_AFTER."""
+        # The bucket is shared by every session in the process, so never freeze it for long
+        delay = min(delay, MAX_RETRY_AFTER)
+        with self.lock:
+            self._refill()
+            # Overlapping holds don't stack, the longest one wins
+            self.tokens = min(self.tokens, -delay * self.rate)
+
+@st.cache_resource
+def get_rate_limiter():
+    """One limiter for the whole process, so concurrent browser sessions share eBay's rate limit too."""
+    return TokenBucket(rate=REQUESTS_PER_SECOND, capacity=REQUESTS_PER_SECOND)
+
+RATE_LIMITER = get_rate_limiter()
+
+def get_cached_response(request):
+    """Returns the disk-cached response for a prepared GET request (fresh or expired), or None if there isn't one."""
+    if requests_cache is None or request.method != "GET":
+        return None
+    return SESSION.cache.get_response(SESSION.cache.create_key(request))
+
+def is_recently_expired(response):
+    """Checks whether an expired cached response is still within HTTP_CACHE_STALE_LIMIT of its expiry."""
+    expires = response.expires
+    if expires is None:
+        return True
+    if expires.tzinfo is None:
+        expires = expires.replace(tzinfo=timezone.utc)
+    return datetime.now(timezone.utc) - expires <= HTTP_CACHE_STALE_LIMIT
+
+def request_with_backoff(url, headers, params=None, method="GET", data=None):
+    """Makes a rate-limited request, backing off and retrying when eBay throttles us."""
+    request = SESSION.prepare_request(requests.Request(method, url, headers=headers, params=params, data=data))
+    settings = SESSION.merge_environment_settings(request.url, {}, None, None, None)
+
+    # A fresh page from the disk cache never reaches eBay, so don't spend a rate limit token or request slot on it
+    cached = get_cached_response(request)
+    if cached is not None and not cached.is_expired:
+        return cached
+
+    for attempt in range(MAX_ATTEMPTS):
+        RATE_LIMITER.acquire()
+        try:
+            with _REQUEST_SLOTS:
+                response = SESSION.send(request, timeout=REQUEST_TIMEOUT, **settings)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            # eBay can't be reached, fall back to a recently expired copy of the page rather than failing the item
+            # Error responses (401, 429, 503...) are never replaced, so token refresh and backoff still happen
+            if cached is not None and is_recently_expired(cached):
+                return cached
+            raise
+
+        if response.status_code not in RETRY_STATUS_CODES or attempt == MAX_ATTEMPTS - 1:
+            return response
+
+        # Honour Retry-After if eBay sends it, otherwise use jittered exponential backoff
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            delay = int(retry_after)
+            if delay > MAX_RETRY_AFTER:
+                # Give up on this request rather than waiting for minutes, the caller reports the error for the item
+                return response
+        else:
+            delay = min(BACKOFF_BASE * 2 ** attempt, BACKOFF_CAP)
+            delay += random.uniform(0, delay)
+        # Back off every worker, not just this one, the retry waits for it in RATE_LIMITER.acquire
+        RATE_LIMITER.hold(delay)
+
+def parse_json(response):
+    """Parses a response body with orjson when it is installed, falling back to the stdlib json module."""
+    return json_parser.loads(response.content)
+
+def fetch_page(params, access_token):
+    """Fetches a single page of search results from the Browse API, params being a dict or an encoded query string."""
+    headers = {**SEARCH_HEADERS, "Authorization": f"Bearer {access_token}"}
+    response = request_with_backoff(SEARCH_URL, headers, params=params)
+
+    if response.status_code == 401:
+        # The token was revoked or expired early, refresh it and retry once
+        invalidate_access_token(access_token)
+        headers["Authorization"] = f"Bearer {get_access_token()}"
+        response = request_with_backoff(SEARCH_URL, headers, params=params)
+        
+    if response.status_code != 200:
+        # Gateway errors can come back as HTML or in an unexpected shape, keep the status code rather than failing on the body
+        try:
+            error_message = parse_json(response).get('errors', [{'message': 'Unknown error'}])[0].get('message', 'Unknown error')
+        except (ValueError, LookupError, AttributeError, TypeError):
+            error_message = 'Unknown error'
+        raise Exception(f"eBay API Error: {error_message} (Status code: {response.status_code})")
+
+    response_data = parse_json(response)
+    # request_with_backoff fell back to an expired cached copy because eBay couldn't be reached, let the caller warn about it
+    if getattr(response, "is_expired", False):
+        response_data["_stale"] = True
+    return response_data
+
+@lru_cache(maxsize=64)
+def keyword_pattern(words, whole_word=False, accented_e=False):
+    """Compiles keywords (a tuple) into a single lowercase regex alternation so each text is scanned once."""
+    if accented_e:
+        # Let every "e" also match "é" or "è", escaping the other characters one by one
+        alternation = "|".join("".join("[eéè]" if char == "e" else re.escape(char) for char in word.lower()) for word in words)
+    else:
+        alternation = "|".join(re.escape(word.lower()) for word in words)
+    if whole_word:
+        # Only match keywords with a space (or the start/end of the text) on either side
+        return re.compile(f"(?<![^ ])(?:{alternation})(?![^ ])")
+    return re.compile(alternation)
+
+# Patterns for the fixed keyword lists are only compiled once
+EXCLUDED_RE = keyword_pattern(EXCLUDED_WORDS)
+ALL_GRADING_RE = keyword_pattern(ALL_GRADING_COMPANIES, whole_word=True)
+POKEMON_CENTER_PROMO_RE = keyword_pattern(POKEMON_CENTER_PROMO_SEARCHES)
+POKEMON_CENTER_NAME_RE = keyword_pattern(POKEMON_CENTER_NAMES)
+# Accents are matched in the pattern itself, so titles are scanned as they are instead of being normalized first
+CENTER_RE = keyword_pattern(CENTER_PATTERNS, accented_e=True)
+# PSA followed by a grade from 1 to 10 ("psa 10" starts with "psa 1", so one digit is enough)
+PSA_GRADE_RE = re.compile(r"psa [1-9]")
+# Either of the above marks a listing as graded, combined so non-graded searches scan each listing once
+GRADED_MARK_RE = re.compile(f"{ALL_GRADING_RE.pattern}|{PSA_GRADE_RE.pattern}")
+
+@st.cache_resource
+def get_page_pool():
+    """Thread pool shared by every item's page fetches, so their pagination overlaps without starting a pool per item."""
+    return ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS, thread_name_prefix="ebay-page")
+
+def fetch_pages(params, access_token, limit=50):
+    """Yields pages of search results, fetching the first page alone and the rest concurrently."""
+    # Encode the query once, only the offset changes from page to page
+    base_query = urlencode({**params, "limit": limit})
+
+    # Fetch the first page to find out how many results there are (eBay allows up to 50 items per page)
+    response_data = fetch_page(f"{base_query}&offset=0", access_token)
+    yield response_data
+    if "next" not in response_data:
+        return
+
+    # Then fetch the remaining pages through a sliding window of MAX_PAGE_WORKERS requests, yielded in order
+    # A new page is requested as soon as the oldest one is handed over, rather than waiting for a whole batch,
+    # and the window keeps one item with many pages from taking over the shared pool
+    total = min(response_data.get("total", 0), MAX_RESULTS)
+    executor = get_page_pool()
+    pending = deque()
     try:
-        url = "https://api.ebay.com/identity/v1/oauth2/token"
-        headers = {
-            "Content-Type": "application/x-www-form-urlencoded",
-            "Authorization": f"Basic {base64_credentials()}"
-        }
-        data = {
-            "grant_type": "refresh_token",
-            "refresh_token": EBAY_API_REFRESH_TOKEN,
-            "scope": "https://api.ebay.com/oauth/api_scope"
-        }
-        response = requests.post(url, headers=headers, data=data)
-        if response.status_code == 200:
-            return response.json()["access_token"]
-        elif response.status_code == 401:
-            raise Exception("Authentication failed. Please check your eBay API credentials.")
+        for offset in range(limit, total, limit):
+            pending.append(executor.submit(fetch_page, f"{base_query}&offset={offset}", access_token))
+            if len(pending) >= MAX_PAGE_WORKERS:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # The caller stopped early (enough matches, or an error), don't fetch pages nobody will read
+        for future in pending:
+            future.cancel()
+
+def keep_listing(title_lower, condition, name_key, name_tokens, is_promo_search, is_pokemon_center_promo, selected_grading_re):
+    """Checks a listing against every filter, returning True if it should be included."""
+    combined_text = title_lower + " " + condition  # Combine title and condition for filtering
+
+    # Step 1: Check excluded words in title and condition with a single scan
+    if EXCLUDED_RE.search(combined_text):
+        return False
+        
+    # Step 2: Handle promo-specific filtering
+    if is_promo_search:
+        # Item must have "promo" in title
+        if "promo" not in title_lower:
+            return False
+            
+        # Special case for Pokemon Center promo searches
+        if is_pokemon_center_promo:
+            # Must have either "pokemon center" or "pokemon centre" in the title
+            if not POKEMON_CENTER_NAME_RE.search(title_lower):
+                return False
+        # Regular promo searches (NOT Pokemon Center promo)
         else:
-            raise Exception(f"Error refreshing access token: {response.json()}")
-    except requests.exceptions.ConnectionError:
-        st.error("Network connection error. Please check your internet connection and try again.")
-        st.stop()
+            # Must NOT contain Pokemon Center/Centre - MORE THOROUGH CHECK
+            # Check for various Center/Centre patterns, CENTER_RE covers accented spellings too
+            if CENTER_RE.search(title_lower):
+                return False
+
+    # Step 3: Handle grading company filtering
+    if selected_grading_re is None:
+        # For "Non-Graded" option
+        # More intelligent check for graded cards
+        # Skip items that are explicitly graded
+        # Check for exact grading company names or explicit mention of "graded"
+        # Don't match "ungraded" as "graded"
+        if "graded" in combined_text and "ungraded" not in combined_text:
+            return False
+        # Check for specific grading companies with space before/after to avoid partial matches,
+        # and for PSA followed by a number (common grading format), in the same scan
+        if GRADED_MARK_RE.search(combined_text):
+            return False
+    else:
+        # For "Graded" option with specific companies selected
+        if not selected_grading_re.search(combined_text):
+            return False
+            
+    # Step 4: Basic item matching
+    return improved_item_matching(name_key, name_tokens, title_lower)
+
+class StaleListings(Exception):
+    """Carries a get_active_listings result built from stale cached pages, which must not be cached itself."""
 
-def base64_credentials():
-    """Generates Base64-encoded credentials."""
-    credentials = f"{EBAY_API_CLIENT_ID}:{EBAY_API_CLIENT_SECRET}"
-    return base64.b64encode(credentials.encode()).decode()
+    def __init__(self, result):
+        super().__init__("Listings were built from stale cached pages")
+        self.result = result
 
-def get_active_listings(item_name, include_shipping, sale_type, grading_companies=[], all_grading_companies=None, exclude_outliers=False):
+def fetch_item_listings(*args, **kwargs):
+    """Calls get_active_listings, returning results built from stale pages without letting them be cached."""
+    try:
+        return get_active_listings(*args, **kwargs)
+    except StaleListings as e:
+        return e.result
+
+@st.cache_data(ttl=SEARCH_CACHE_TTL, max_entries=SEARCH_CACHE_MAX_ENTRIES, show_spinner=False)
+def get_active_listings(item_name, include_shipping, sale_type, listing_count, grading_companies=(), exclude_outliers=False, _access_token=None):
     """Fetch active listings from eBay using the Browse API with pagination."""
     try:
-        # Use default list if none provided
-        if all_grading_companies is None:
-            all_grading_companies = ["PSA", "BECKETT", "BGS", "CGC", "SGC", "AGS", "TAG", "ACE"]
-        
-        # Words to exclude from search results
-        excluded_words = ["Magnetic", "Stand", "Proxy", "Custom", "Box", "Playmat"]
+        # Only the selected companies vary per search, and the pattern is shared by every item in the batch
+        selected_grading_re = keyword_pattern(grading_companies, whole_word=True) if grading_companies else None
         
         # Check if item name contains promo types
         item_lower = item_name.lower()
+        name_key = item_lower.replace("'", "")  # Normalized once for matching against every title
+        name_tokens = name_key.split()  # Tokenized once too, rather than for every title that isn't an exact match
         is_promo_search = "promo" in item_lower
-        is_pokemon_center_promo = any(pc in item_lower for pc in ["pokemon center promo", "pokemon centre promo"])
+        is_pokemon_center_promo = POKEMON_CENTER_PROMO_RE.search(item_lower) is not None
 
-        # Get a new access token
-        access_token = get_access_token()
+        # Use the token shared by the batch if given (the leading underscore keeps it out of the cache key)
+        access_token = _access_token or get_access_token()
 
         # Set up API request
-        base_url = f"https://api.ebay.com/buy/browse/v1/item_summary/search?q={item_name}"
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json",
-            "X-EBAY-C-MARKETPLACE-ID": "EBAY_GB"  # Specify the UK marketplace
-        }
+        # Only ask for the matching items, not the refinement/extended field groups we never read
+        # requests URL-encodes the params, so item names with &, # or accents are searched as typed
+        params = {"q": item_name, "fieldgroups": "MATCHING_ITEMS"}
+        # Most expensive first, so the matches collected before paging stops early are the ones that would be kept
+        params["sort"] = "-price"
 
         # Add filters
         filters = []
@@ -168,43 +602,24 @@ def get_active_listings(item_name, include_shipping, sale_type, grading_companie
         filters.append("itemLocationCountry:GB")  # UK-only results
 
         if filters:
-            base_url += f"&filter={','.join(filters)}"
-
-        # Pagination variables
-        all_prices = []
-        all_links = []
-        all_titles = []
-        all_conditions = []  # Add this line to store condition descriptions
-        offset = 0
-        limit = 50  # eBay API allows up to 50 items per page
-
-        while True:
-            # Add pagination parameters
-            url = f"{base_url}&limit={limit}&offset={offset}"
-
-            # Make the API request
-            response = requests.get(url, headers=headers)
-
-            if response.status_code == 429:  # Too Many Requests
-                st.warning("eBay API rate limit reached. Waiting before retrying...")
-                time.sleep(5)  # Wait 5 seconds before retrying
-                response = requests.get(url, headers=headers)
-                
-            if response.status_code != 200:
-                error_message = response.json().get('errors', [{'message': 'Unknown error'}])[0].get('message', 'Unknown error')
-                raise Exception(f"eBay API Error: {error_message} (Status code: {response.status_code})")
-
-            # Parse the response
-            response_data = response.json()
-            if "itemSummaries" not in response_data:
-                break  # No more items to fetch
+            params["filter"] = ",".join(filters)
 
-            # Extract listings
+        # Filtered results, built up page by page
+        filtered_prices = []
+        filtered_links = []
+        filtered_titles = []
+        # Stop paging once there are comfortably more matches than will be shown
+        enough_matches = listing_count * 3
+        # Bind the per-listing calls to locals, the loop below runs for every listing on every page
+        keep = keep_listing
+        add_price, add_link, add_title = filtered_prices.append, filtered_links.append, filtered_titles.append
+
+        used_stale_page = False
+        for response_data in fetch_pages(params, access_token):
+            used_stale_page = used_stale_page or response_data.get("_stale", False)
+            # Extract and filter listings
             for item in response_data.get("itemSummaries", []):
-                title = item.get("title", "").lower()
-                price = float(item["price"]["value"])
-                if include_shipping and "shippingOptions" in item:
-                    price += float(item["shippingOptions"][0]["shippingCost"]["value"])
+                title = item.get("title", "")
                 
                 # Extract condition information - less invasive debug approach
                 condition_description = ""
@@ -221,137 +636,59 @@ def get_active_listings(item_name, include_shipping, sale_type, grading_companie
                 else:
                     condition_description = ""
 
-                # Store data without excessive debugging output
-                all_prices.append(price)
-                all_links.append(item.get("itemWebUrl", "").replace("ebay.com", "ebay.co.uk"))
-                all_titles.append(item.get("title", ""))
                 # Store condition information for filtering - include display name as well
-                all_conditions.append(f"{condition_display_name} {condition_description}".lower())
-
-            # Check if there are more pages
-            if "next" not in response_data:
-                break
-            offset += limit  # Move to the next page
-
-        # After collecting all listings but before filtering
-
-        # Filter results locally 
-        filtered_prices = []
-        filtered_links = []
-        filtered_titles = []
-
-        for price, link, title, condition in zip(all_prices, all_links, all_titles, all_conditions):
-            title_lower = title.lower()
-            should_include = True
-            
-            # Step 1: Check excluded words in title and condition
-            if any(word.lower() in title_lower for word in excluded_words) or any(word.lower() in condition for word in excluded_words):
-                should_include = False
-                continue
-                
-            # Step 2: Handle promo-specific filtering
-            if is_promo_search:
-                # Item must have "promo" in title
-                if "promo" not in title_lower:
-                    should_include = False
-                    continue
-                    
-                # Special case for Pokemon Center promo searches
-                if is_pokemon_center_promo:
-                    # Must have either "pokemon center" or "pokemon centre" in the title
-                    if not any(pc in title_lower for pc in ["pokemon center", "pokemon centre"]):
-                        should_include = False
-                        continue
-                # Regular promo searches (NOT Pokemon Center promo)
-                else:
-                    # Must NOT contain Pokemon Center/Centre - MORE THOROUGH CHECK
-                    # Normalize accented characters for comparison
-                    normalized_title = title_lower.replace("é", "e").replace("è", "e")
-                    
-                    # Check for various Center/Centre patterns with both normalized and original text
-                    center_patterns = [
-                        "pokemon center", "pokemon centre", 
-                        "center stamped", "centre stamped", 
-                        "pc stamped", "pc stamp", 
-                        "center pc", "centre pc",
-                        "pokémon center", "pokémon centre"  # Explicit check with accented é
-                    ]
-                    
-                    has_center_phrase = any(pattern in normalized_title or pattern in title_lower 
-                                           for pattern in center_patterns)
-                    
-                    if has_center_phrase:
-                        should_include = False
-                        continue
-
-            # Step 3: Handle grading company filtering
-            combined_text = title_lower + " " + condition  # Combine title and condition for filtering
+                condition = f"{condition_display_name} {condition_description}".lower()
 
-            if not grading_companies:
-                # For "Non-Graded" option
-                # More intelligent check for graded cards
-                is_graded = False
-                
-                # Skip items that are explicitly graded
-                # Check for exact grading company names or explicit mention of "graded"
-                # Don't match "ungraded" as "graded"
-                if "graded" in combined_text and "ungraded" not in combined_text:
-                    is_graded = True
-                # Check for specific grading companies with space before/after to avoid partial matches
-                elif any(f" {company.lower()} " in f" {combined_text} " for company in all_grading_companies):
-                    is_graded = True
-                # Also check for PSA followed by a number (common grading format)
-                elif any(f"psa {str(i)}" in combined_text for i in range(1, 11)):
-                    is_graded = True
-                    
-                if is_graded:
-                    should_include = False
+                # Keep the listing only if it passes every filter
+                if not keep(title.lower(), condition, name_key, name_tokens, is_promo_search, is_pokemon_center_promo, selected_grading_re):
                     continue
-            else:
-                # For "Graded" option with specific companies selected
-                # This case is working fine, keep it as is
-                is_graded_by_selected = any(f" {company.lower()} " in f" {combined_text} " for company in grading_companies)
-                
-                if not is_graded_by_selected:
-                    should_include = False
-                    continue
-                    
-            # Step 4: Basic item matching
-            if not improved_item_matching(item_name, title):
-                should_include = False
-                continue
-                
-            # If we got here, the item passed all filters
-            if should_include:
-                filtered_prices.append(price)
-                filtered_links.append(link)
-                filtered_titles.append(title)
-
-        # Combine the filtered results into a single list of tuples
-        filtered_results = list(zip(filtered_prices, filtered_links, filtered_titles))
-
-        # Sort the filtered results by price in descending order
-        filtered_results.sort(key=lambda x: x[0], reverse=True)
 
-        # Unpack the sorted results back into separate lists
-        filtered_prices, filtered_links, filtered_titles = zip(*filtered_results) if filtered_results else ([], [], [])
+                # Price and link are only needed for the listings that are kept
+                price = float(item["price"]["value"])
+                if include_shipping and "shippingOptions" in item:
+                    price += float(item["shippingOptions"][0]["shippingCost"]["value"])
+                link = item.get("itemWebUrl", "").replace("ebay.com", "ebay.co.uk")
+                add_price(price)
+                add_link(link)
+                add_title(title)
+
+            # Check if we have enough matches to skip the remaining pages
+            # Outlier filtering needs every match to compute its quartiles, so it always reads all pages
+            if len(filtered_prices) >= enough_matches and not exclude_outliers:
+                break
 
-        # Apply outlier filtering if requested - ADD THIS CODE
+        # Apply outlier filtering if requested - the IQR needs every match, so do it before picking the top listings
         if exclude_outliers and len(filtered_prices) >= 4:
             filtered_prices, filtered_links, filtered_titles = filter_outliers(filtered_prices, filtered_links, filtered_titles)
 
-        # Restrict the number of listings to the selected count
-        filtered_prices = filtered_prices[:listing_count]
-        filtered_links = filtered_links[:listing_count]
-        filtered_titles = filtered_titles[:listing_count]
-
-        # Calculate the average price and round down to 2 decimal places
-        avg_price = math.floor((sum(filtered_prices) / len(filtered_prices)) * 100) / 100 if filtered_prices else 0.0
+        # Keep only the most expensive listings, up to the selected count, in descending price order
+        prices_array = np.asarray(filtered_prices, dtype=np.float64)
+        candidates = np.arange(len(prices_array))
+        if len(prices_array) > listing_count:
+            # Find the listing_count-th highest price in linear time and only sort listings priced at or above it
+            cutoff = np.partition(prices_array, len(prices_array) - listing_count)[len(prices_array) - listing_count]
+            candidates = np.flatnonzero(prices_array >= cutoff)
+        # A stable argsort on the negated prices keeps equally priced listings in the order eBay returned them
+        order = candidates[np.argsort(-prices_array[candidates], kind="stable")][:listing_count]
+        filtered_prices = prices_array[order].tolist()
+        filtered_links = [filtered_links[i] for i in order]
+        filtered_titles = [filtered_titles[i] for i in order]
+
+        # Calculate the average price and round down to 2 decimal places, leaving it blank if nothing matched
+        avg_price = math.floor((sum(filtered_prices) / len(filtered_prices)) * 100) / 100 if filtered_prices else None
         warning = "" if filtered_prices else "No matching listings found."
+        if used_stale_page:
+            warning = " ".join(filter(None, [warning, "eBay couldn't be reached, some prices come from an older cached search."]))
 
         # Return the filtered results
-        return avg_price, filtered_prices, filtered_links, filtered_titles, warning
-
+        result = avg_price, filtered_prices, filtered_links, filtered_titles, warning
+        if used_stale_page:
+            # Raised rather than returned so st.cache_data doesn't keep stale prices once eBay is back
+            raise StaleListings(result)
+        return result
+
+    except StaleListings:
+        raise
     except requests.exceptions.RequestException as e:
         raise Exception(f"Network error: {e}")
     except ValueError as e:
@@ -359,32 +696,18 @@ def get_active_listings(item_name, include_shipping, sale_type, grading_companie
     except Exception as e:
         raise Exception(f"Error fetching active listings for {item_name}: {e}")
 
-def improved_item_matching(item_name, title):
-    # Normalize text: lowercase and remove apostrophes
-    norm_item = item_name.lower().replace("'", "")
-    norm_title = title.lower().replace("'", "")
+def improved_item_matching(norm_item, item_tokens, title_lower):
+    # norm_item is already lowercase with apostrophes removed and item_tokens is its split, normalize the title the same way
+    norm_title = title_lower.replace("'", "")
     
     # Check for exact substring match first (current approach)
     if norm_item in norm_title:
         return True
     
-    # Split into tokens/words
-    item_tokens = norm_item.split()
-    title_tokens = norm_title.split()
-    
     # Check if most of the search terms appear in the title
-    matches = 0
-    for token in item_tokens:
-        # Special handling for card numbers (e.g., 183/159)
-        if '/' in token and any('/' in t for t in title_tokens):
-            card_numbers = [t for t in title_tokens if '/' in t]
-            if any(token == num for num in card_numbers):
-                matches += 1
-                continue
-        
-        # Regular token matching
-        if token in title_tokens or any(token in t for t in title_tokens):
-            matches += 1
+    # A token has no whitespace, so it is inside one of the title's words exactly when it is inside the title,
+    # which makes a substring check on the whole title the same as checking each title word without splitting it
+    matches = sum(1 for token in item_tokens if token in norm_title)
     
     # Return True if most tokens match (e.g., 75% or more)
     match_ratio = matches / len(item_tokens)
@@ -396,35 +719,26 @@ def filter_outliers(prices, links, titles):
         return prices, links, titles
         
     # Convert to numpy array for stats operations
-    prices_array = np.array(prices)
+    prices_array = np.asarray(prices, dtype=np.float64)
     
-    # Calculate Q1, Q3 and IQR
-    q1 = np.percentile(prices_array, 25)
-    q3 = np.percentile(prices_array, 75)
+    # Calculate Q1, Q3 and IQR in a single call
+    q1, q3 = np.quantile(prices_array, [0.25, 0.75])
     iqr = q3 - q1
     
     # Define outlier boundaries (use 1.5 for standard outliers, but we'll use a tighter bound)
     # For more aggressive filtering, reduce the multiplier from 1.5 to 1.0
-    lower_bound = q1 - 1.0 * iqr
-    upper_bound = q3 + 1.0 * iqr
-    
-    # Filter out outliers
-    filtered_indices = []
-    for i, price in enumerate(prices):
-        if lower_bound <= price <= upper_bound:
-            filtered_indices.append(i)
+    mask = (prices_array >= q1 - 1.0 * iqr) & (prices_array <= q3 + 1.0 * iqr)
     
     # If filtering removed too many results (less than 3), use a less aggressive approach
-    if len(filtered_indices) < 3 and len(prices) > 3:
-        # Try again with standard 1.5 IQR
-        lower_bound = q1 - 1.5 * iqr
-        upper_bound = q3 + 1.5 * iqr
-        filtered_indices = [i for i, price in enumerate(prices) if lower_bound <= price <= upper_bound]
+    if np.count_nonzero(mask) < 3:
+        # Fall back to the standard 1.5 IQR
+        mask = (prices_array >= q1 - 1.5 * iqr) & (prices_array <= q3 + 1.5 * iqr)
     
-    # Extract non-outlier data
-    filtered_prices = [prices[i] for i in filtered_indices]
-    filtered_links = [links[i] for i in filtered_indices]
-    filtered_titles = [titles[i] for i in filtered_indices]
+    # Extract non-outlier data, gathering the links and titles by index rather than copying them into object arrays
+    keep = np.flatnonzero(mask)
+    filtered_prices = prices_array[keep].tolist()
+    filtered_links = [links[i] for i in keep]
+    filtered_titles = [titles[i] for i in keep]
     
     return filtered_prices, filtered_links, filtered_titles
 
@@ -514,7 +828,7 @@ if st.button("Refresh Prices"):
                             st.stop()
 
                 # Fetch eBay data (Active Listings only)
-                averages, results = fetch_ebay_data(
+                averages_df, results_df = fetch_ebay_data(
                     data, 
                     include_shipping=include_shipping, 
                     sale_type=sale_type, 
@@ -525,53 +839,31 @@ if st.button("Refresh Prices"):
                 )
 
                 # Display results
-                if results:
-                    # Create a dictionary to organize results by item
-                    items_data = {}
-                    
-                    # First gather all data by item name
-                    for item_name in set(r["Item"] for r in results):
-                        # Get average price for this item
-                        avg_info = next((a for a in averages if a["Item"] == item_name), None)
-                        
-                        # Get listings for this item
-                        item_listings = [r for r in results if r["Item"] == item_name]
-                        
-                        # Store data
-                        items_data[item_name] = {
-                            "Item": item_name,
-                            "Unit Average Price (GBP)": avg_info.get("Unit Average Price (GBP)") if avg_info else None,
-                            "Warning": avg_info.get("Warning", "") if avg_info else "",
-                            "Listings": item_listings
-                        }
-                    
-                    # Create the horizontal layout
-                    horizontal_results = []
-                    for item_name, data in items_data.items():
-                        row = {
-                            "Item": data["Item"],
-                            "Unit Average Price (GBP)": data["Unit Average Price (GBP)"],
-                            "Warning": data["Warning"]
-                        }
-                        
-                        # Add each listing as separate columns with clickable links
-                        for i, listing in enumerate(data["Listings"]):
-                            price = listing.get('Price (GBP)', '')
-                            title = listing.get('Title', '')
-                            link = listing.get('Link', '')
-                            
-                            if price and title and link:
-                                # Create a markdown link
-                                row[f"Listing {i+1}"] = f"{price} - [{title}]({link})"
-                            else:
-                                row[f"Listing {i+1}"] = f"{price} - {title}"
-                        
-                        horizontal_results.append(row)
+                if not results_df.empty:
+                    # Number each item's listings 1, 2, 3... and build every cell's text in one pass
+                    results_df["n"] = results_df.groupby("Item", sort=False).cumcount() + 1
+                    prices = results_df["Price (GBP)"]
+                    results_df["Listing"] = prices.astype(str).where(prices.notna(), "None") + " - " + results_df["Title"]
+
+                    # Pivot to one row per item, with a Listing/Link column pair for each listing
+                    listings_df = results_df.pivot(index="Item", columns="n", values=["Listing", "Link"])
+                    columns = [(kind, n) for n in range(1, results_df["n"].max() + 1) for kind in ("Listing", "Link")]
+                    listings_df = listings_df[columns]
+                    listings_df.columns = [f"{kind} {n}" for kind, n in columns]
+
+                    # Create the horizontal layout, keeping the items in input order
+                    horizontal_df = averages_df.drop_duplicates("Item", keep="first").merge(
+                        listings_df, left_on="Item", right_index=True, how="left"
+                    )
 
                     # Display the horizontal table
-                    horizontal_df = pd.DataFrame(horizontal_results)
                     st.markdown("### Results")
-                    st.markdown(horizontal_df.to_markdown(index=False), unsafe_allow_html=True)
+                    st.dataframe(
+                        horizontal_df,
+                        column_config={col: st.column_config.LinkColumn() for col in horizontal_df.columns if col.startswith("Link ")},
+                        use_container_width=True,
+                        hide_index=True
+                    )
                     
                     # Add download button for the horizontal results
                     st.download_button("Download Results CSV", horizontal_df.to_csv(index=False), "results.csv")